@@ -4,13 +4,41 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import json
+"""Export per-revision review statistics from a Phabricator database.
+
+Per-revision queries only stay cheap if they are index lookups. Stock
+Phabricator schemas provide every index used here; check with EXPLAIN when
+running against a restored or hand-built copy:
+
+- differential_diff (revisionID)
+- differential_changeset (diffID)
+- differential_transaction_comment (changesetID) and (phid)
+- differential_transaction (objectPHID), optionally extended with
+  transactionType
+- differential_reviewer (revisionPHID, reviewerPHID)
+- repository_uri (repositoryPHID)
+
+The edge, user, project and revision tables are read in full once at startup,
+so they need no extra indexes.
+"""
+
 import os
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import orjson
 import sqlalchemy
-from sqlalchemy import or_
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.orm import (
+    Session,
+    column_property,
+    foreign,
+    relationship,
+    scoped_session,
+    selectinload,
+    sessionmaker,
+)
 from sqlalchemy.ext.automap import automap_base
 
 DB_URL = os.environ.get("PHAB_URL", "127.0.0.1")
@@ -18,31 +46,53 @@ DB_NAMESPACE = os.environ.get("PHAB_NAMESPACE", "bitnami_phabricator")
 DB_PORT = os.environ.get("PHAB_PORT", "3307")
 DB_USER = os.environ.get("PHAB_USER", "root")
 DB_TOKEN = os.environ["PHAB_TOKEN"]
+WORKERS = int(os.environ.get("PHAB_WORKERS", "16"))
+POOL_SIZE = int(os.environ.get("PHAB_POOL_SIZE", "20"))
+
+
+def create_engine(database):
+    # Size the pool for the worker threads plus the revision stream, and check
+    # connections before use since a full run can outlive MySQL's idle timeout.
+    return sqlalchemy.create_engine(
+        f"mysql+mysqldb://{DB_USER}:{DB_TOKEN}@{DB_URL}:{DB_PORT}/{DB_NAMESPACE}_{database}",
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_SIZE,
+        pool_recycle=3600,
+        pool_pre_ping=True,
+        query_cache_size=1200,
+    )
+
 
 Base = automap_base()
 
+# Everything lives in per-application schemas on one MySQL server, so a single
+# engine on the differential schema reaches the user and repository tables by
+# their qualified names and lets queries join across schemas.
+engine = create_engine("differential")
+session = scoped_session(sessionmaker(engine))
+
 # Users
-engine_user = sqlalchemy.create_engine(
-    f"mysql+mysqldb://{DB_USER}:{DB_TOKEN}@{DB_URL}:{DB_PORT}/{DB_NAMESPACE}_user"
+Base.prepare(
+    engine, schema=f"{DB_NAMESPACE}_user", reflection_options={"only": ["user"]}
 )
-Base.prepare(engine_user)
-session_users = Session(engine_user)
 User = Base.classes.user
 
 # Repositories
-engine_repo = engine_user = sqlalchemy.create_engine(
-    f"mysql+mysqldb://{DB_USER}:{DB_TOKEN}@{DB_URL}:{DB_PORT}/{DB_NAMESPACE}_repository"
+Base.prepare(
+    engine,
+    schema=f"{DB_NAMESPACE}_repository",
+    reflection_options={"only": ["repository_uri"]},
 )
-Base.prepare(engine_repo)
-session_repo = Session(engine_repo)
 Repo = Base.classes.repository_uri
 
-# Diffs
-engine_diffenrential = sqlalchemy.create_engine(
-    f"mysql+mysqldb://{DB_USER}:{DB_TOKEN}@{DB_URL}:{DB_PORT}/{DB_NAMESPACE}_differential"
+# Projects
+Base.prepare(
+    engine, schema=f"{DB_NAMESPACE}_project", reflection_options={"only": ["project"]}
 )
-Base.prepare(engine_diffenrential)
-session_diff = Session(engine_diffenrential)
+Project = Base.classes.project
+
+# Diffs
+Base.prepare(engine)
 Revision = Base.classes.differential_revision
 Diff = Base.classes.differential_diff
 Changeset = Base.classes.differential_changeset
@@ -51,111 +101,207 @@ TransactionComment = Base.classes.differential_transaction_comment
 Reviewer = Base.classes.differential_reviewer
 Edges = Base.classes.edge
 
-# Results
-output = {}
-revisions = session_diff.query(Revision)
-for revision in revisions:
-    rev_key = f"D{revision.id}"
-    output[rev_key] = {}
-    output[rev_key]["first submission timestamp (dateCreated)"] = revision.dateCreated
-    output[rev_key]["last review id (lastReviewerPHID)"] = revision.lastReviewerPHID
-    output[rev_key]["current status"] = revision.status
-    repository = session_repo.query(Repo).filter_by(
-        repositoryPHID=revision.repositoryPHID
+# The schema has no foreign keys, so spell out the diff -> changeset -> inline
+# comment relationships to let a revision's whole tree be eager loaded.
+Diff.changesets = relationship(
+    Changeset, primaryjoin=Diff.id == foreign(Changeset.diffID), viewonly=True
+)
+Changeset.comments = relationship(
+    TransactionComment,
+    primaryjoin=Changeset.id == foreign(TransactionComment.changesetID),
+    viewonly=True,
+)
+# Comments are exported by length only, so let MySQL count the characters
+# rather than shipping every comment body over the wire.
+TransactionComment.contentLength = column_property(
+    func.char_length(TransactionComment.content)
+)
+
+# Authors and reviewers are shared by many revisions, so load the few columns
+# needed from the whole user and project tables once instead of querying them
+# per PHID. Reviewers can be either users or projects (reviewer groups).
+users = {
+    user.phid: user
+    for user in session.query(User.phid, User.userName, User.isMailingList)
+}
+projects = dict(session.query(Project.phid, Project.name))
+
+# Walk revision stacks in memory: load every dependency edge once, in both
+# directions, along with the bug id each revision title starts with.
+stack_edges = defaultdict(set)
+for src, dst in session.query(Edges.src, Edges.dst).filter(Edges.type.in_([5, 6])):
+    stack_edges[src].add(dst)
+    stack_edges[dst].add(src)
+bug_ids = {
+    phid: title.split("-")[0]
+    for phid, title in session.query(Revision.phid, Revision.title)
+}
+# Done with the main thread's session; the workers check out their own.
+session.remove()
+
+# Per-revision statements are built once; each execution only binds new
+# parameters and reuses the engine's compiled SQL. Flat lookups select plain
+# rows rather than ORM objects since nothing here is ever written back.
+diffs_query = (
+    select(Diff)
+    .where(Diff.revisionID == bindparam("revision_id"))
+    .options(
+        selectinload(Diff.changesets)
+        .selectinload(Changeset.comments)
+        .defer(TransactionComment.content)
     )
-    output[rev_key]["target repository"] = repository.first().uri
-    # stack (edge dependencies)
-    stack = set()
-    neighbors = {revision.phid}
-    bug_id = revision.title.split("-")[0]
-    while len(neighbors) > 0:
-        query_result = session_diff.query(Edges).filter(
-            or_(Edges.src.in_(neighbors), Edges.src.in_(neighbors)),
-            or_(Edges.type.in_([5, 6])),
+)
+reviews_query = select(
+    Reviewer.id,
+    Reviewer.reviewerPHID,
+    Reviewer.dateCreated,
+    Reviewer.dateModified,
+    Reviewer.reviewerStatus,
+).where(Reviewer.revisionPHID == bindparam("revision"))
+comments_query = select(
+    TransactionComment.id,
+    TransactionComment.authorPHID,
+    TransactionComment.dateCreated,
+    TransactionComment.contentLength,
+).where(
+    TransactionComment.phid.in_(
+        select(Transaction.commentPHID).where(
+            Transaction.objectPHID == bindparam("revision"),
+            Transaction.transactionType == "core:comment",
         )
-        revlist = []
-        for edge in query_result.all():
-            for rev_src in revisions.filter_by(phid=edge.src):
-                if rev_src.title.split("-")[0] == bug_id:
-                    revlist.append(rev_src.phid)
-            for rev_dst in revisions.filter_by(phid=edge.dst):
-                if rev_dst.title.split("-")[0] == bug_id:
-                    revlist.append(rev_dst.phid)
-        stack = stack | neighbors
-        neighbors = set(revlist) - stack
-    stack_size = len(stack)
-    output[rev_key]["stack size"] = stack_size
-    # diffs
-    output[rev_key]["diffs"] = {}
-    for diff in session_diff.query(Diff).filter_by(revisionID=revision.id):
-        diff_id = f"diff-{diff.id}"
-        current_diff = output[rev_key]["diffs"][diff_id] = {}
-        current_diff["submission time (dateCreated)"] = diff.dateCreated
-        user = session_users.query(User).filter_by(phid=diff.authorPHID).one()
-        current_diff["author (userName)"] = user.userName
-        # changesets
-        current_diff["changesets"] = {}
-        for changeset in session_diff.query(Changeset).filter_by(diffID=diff.id):
-            changeset_id = f"changeset-{changeset.id}"
-            current_diff["changesets"][changeset_id] = {
-                "lines added": changeset.addLines,
-                "lines removed": changeset.delLines,
-            }
-            # comments
-            current_diff["changesets"][changeset_id]["comments"] = {}
-            for comment in session_diff.query(TransactionComment).filter_by(
-                changesetID=changeset.id
-            ):
-                comment_id = f"comment-{comment.id}"
-                user = (
-                    session_users.query(User).filter_by(phid=comment.authorPHID).one()
-                )
-                current_diff["changesets"][changeset_id]["comments"][comment_id] = {
-                    "author": user.userName,
-                    "timestamp (dateCreated)": comment.dateCreated,
-                    "character count": len(comment.content),
+    )
+)
+
+
+def is_suggestion(attributes):
+    # Most inline comments aren't suggestions, so only decode the attributes
+    # when the key can actually be present.
+    if "hassuggestion" not in attributes:
+        return False
+    state = orjson.loads(attributes).get("inline.state.initial", {})
+    return state.get("hassuggestion") == "true"
+
+
+def process_revision(revision):
+    # Release the worker's session after each revision so its connection goes
+    # back to the pool, where it is recycled and pre-pinged on the next checkout.
+    try:
+        result = {}
+        result["first submission timestamp (dateCreated)"] = revision.dateCreated
+        result["last review id (lastReviewerPHID)"] = revision.lastReviewerPHID
+        result["current status"] = revision.status
+        result["target repository"] = revision.repositoryURI
+        # stack (edge dependencies)
+        stack = set()
+        neighbors = {revision.phid}
+        bug_id = revision.title.split("-")[0]
+        while len(neighbors) > 0:
+            revlist = [
+                phid
+                for neighbor in neighbors
+                for phid in stack_edges.get(neighbor, ())
+                if bug_ids.get(phid) == bug_id
+            ]
+            stack = stack | neighbors
+            neighbors = set(revlist) - stack
+        stack_size = len(stack)
+        result["stack size"] = stack_size
+        # diffs
+        result["diffs"] = {}
+        diffs = session.scalars(diffs_query, {"revision_id": revision.id})
+        for diff in diffs:
+            diff_id = f"diff-{diff.id}"
+            current_diff = result["diffs"][diff_id] = {}
+            current_diff["submission time (dateCreated)"] = diff.dateCreated
+            current_diff["author (userName)"] = users[diff.authorPHID].userName
+            # changesets
+            current_diff["changesets"] = {}
+            for changeset in diff.changesets:
+                changeset_id = f"changeset-{changeset.id}"
+                current_diff["changesets"][changeset_id] = {
+                    "lines added": changeset.addLines,
+                    "lines removed": changeset.delLines,
                 }
-                att = json.loads(comment.attributes)
-                is_suggestion = False
-                if "inline.state.initial" in att:
-                    hassuggestion = att["inline.state.initial"].get("hassuggestion")
-                    if hassuggestion == "true":
-                        is_suggestion = True
-                        break
-                current_diff["changesets"][changeset_id]["comments"][comment_id][
-                    "is_suggestion"
-                ] = is_suggestion
+                # comments
+                current_diff["changesets"][changeset_id]["comments"] = {}
+                for comment in changeset.comments:
+                    comment_id = f"comment-{comment.id}"
+                    current_diff["changesets"][changeset_id]["comments"][comment_id] = {
+                        "author": users[comment.authorPHID].userName,
+                        "timestamp (dateCreated)": comment.dateCreated,
+                        "character count": comment.contentLength,
+                        "is_suggestion": is_suggestion(comment.attributes),
+                    }
+
         # reviews
-        current_diff["review requests"] = {}
-        for review in session_diff.query(Reviewer).filter_by(
-            revisionPHID=revision.phid
-        ):
-            reviewer = (
-                session_users.query(User).filter_by(phid=review.reviewerPHID).one()
-            )
-            current_diff["review requests"][f"review-{review.id}"] = {
-                "reviewer": reviewer.userName,
-                "group (isMailingList)": bool(reviewer.isMailingList),
+        result["review requests"] = {}
+        reviews = session.execute(reviews_query, {"revision": revision.phid})
+        for review in reviews:
+            if review.reviewerPHID in projects:
+                reviewer_name = projects[review.reviewerPHID]
+                is_group = True
+            else:
+                reviewer = users[review.reviewerPHID]
+                reviewer_name = reviewer.userName
+                is_group = bool(reviewer.isMailingList)
+            result["review requests"][f"review-{review.id}"] = {
+                "reviewer": reviewer_name,
+                "group (isMailingList)": is_group,
                 "creation timestamp": review.dateCreated,
                 "review timestamp": review.dateModified,
                 "status": review.reviewerStatus,
             }
 
-    # comments
-    output[rev_key]["comments"] = {}
-    for transaction in session_diff.query(Transaction).filter_by(
-        objectPHID=revision.phid
-    ):
-        if transaction.transactionType == "core:comment":
-            comment = (
-                session_diff.query(TransactionComment)
-                .filter_by(phid=transaction.commentPHID)
-                .one()
-            )
+        # comments
+        result["comments"] = {}
+        comments = session.execute(comments_query, {"revision": revision.phid})
+        for comment in comments:
             comment_id = f"comment-{comment.id}"
-            output[rev_key]["comments"][comment_id] = {
-                "author": user.userName,
+            result["comments"][comment_id] = {
+                "author": users[comment.authorPHID].userName,
                 "timestamp (dateCreated)": comment.dateCreated,
-                "character count": len(comment.content),
+                "character count": comment.contentLength,
             }
-Path("revisions.json").write_text(json.dumps(output, indent=2))
+        return f"D{revision.id}", result
+    finally:
+        session.remove()
+
+
+# Results
+# Stream revisions in batches. yield_per keeps the MySQL cursor open for the
+# whole loop, so it gets its own session and connection to leave the scoped
+# session free for the per-revision queries.
+session_revisions = Session(engine)
+revisions = session_revisions.execute(
+    select(
+        Revision.id,
+        Revision.phid,
+        Revision.title,
+        Revision.dateCreated,
+        Revision.lastReviewerPHID,
+        Revision.status,
+        # a repository can have several URIs; report the first one
+        select(Repo.uri)
+        .where(Repo.repositoryPHID == Revision.repositoryPHID)
+        .limit(1)
+        .scalar_subquery()
+        .label("repositoryURI"),
+    ).execution_options(yield_per=1000)
+)
+# Revisions are independent and mostly wait on MySQL round trips, so process
+# them concurrently; each worker thread gets its own sessions. Results are
+# written out one line per revision as they complete, in order, and only a
+# bounded window of revisions is in flight so memory stays flat.
+with (
+    ThreadPoolExecutor(max_workers=WORKERS) as executor,
+    Path("revisions.ndjson").open("wb") as output,
+):
+    pending = deque()
+    for revision in revisions:
+        pending.append(executor.submit(process_revision, revision))
+        if len(pending) >= 2 * WORKERS:
+            rev_key, result = pending.popleft().result()
+            output.write(orjson.dumps({rev_key: result}) + b"\n")
+    for future in pending:
+        rev_key, result = future.result()
+        output.write(orjson.dumps({rev_key: result}) + b"\n")